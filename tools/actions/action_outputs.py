@@ -0,0 +1,134 @@
+# Copyright 2017 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Helpers shared by the scripts that collect bazel extra_action outputs.
+
+These are used by generate_compile_commands_json.py and
+generate_link_targets_json.py, which walk the outputs of every extra_action of
+their type and combine them into a single JSON database.
+"""
+
+import json
+import os
+import subprocess
+
+try:
+  import orjson
+except ImportError:
+  orjson = None
+
+
+# Number of threads used to read action output files. Reads are independent
+# and I/O bound so we oversubscribe the available cores.
+MAX_WORKERS = min(32, (os.cpu_count() or 1) * 4)
+
+
+def dumps(obj):
+  """Serializes obj as compact UTF-8 JSON, using orjson if it is available."""
+  if orjson:
+    return orjson.dumps(obj)
+  return json.dumps(obj, ensure_ascii=False,
+                    separators=(',', ':')).encode('utf-8')
+
+
+def iter_action_files(path, suffix):
+  """Recursively yields all action output files under a directory.
+
+  This uses os.scandir directly instead of os.walk so that the file type
+  information returned by the directory listing is reused without additional
+  stat calls. Empty files are skipped without being opened, as actions with
+  nothing to report still have to produce their declared output.
+
+  Args:
+    path: A directory path to look for action output files under.
+    suffix: Filename suffix of the files to yield, such as '_link_target'.
+
+  Yields:
+    An os.DirEntry for each matching file. Its stat() result is cached.
+  """
+  # Bound to locals as these are looked up for every entry in the tree.
+  scandir = os.scandir
+  pending_dirs = [path]
+  push_dir = pending_dirs.append
+  pop_dir = pending_dirs.pop
+  while pending_dirs:
+    try:
+      it = scandir(pop_dir())
+    except OSError:
+      # The directory may not exist if no actions of this type were run.
+      continue
+    with it:
+      for entry in it:
+        try:
+          if entry.is_dir(follow_symlinks=False):
+            push_dir(entry.path)
+            continue
+          if (not entry.is_file(follow_symlinks=False) or
+              not entry.name.endswith(suffix) or
+              not entry.stat(follow_symlinks=False).st_size):
+            continue
+        except OSError:
+          # The entry was removed or replaced while walking.
+          continue
+        yield entry
+
+
+def write_json_array(f, records, shared_fields=None):
+  """Streams records to a file as a JSON array.
+
+  Each record is serialized as it is written so that only one entry is ever
+  held as a string in memory. Output is always UTF-8 regardless of platform.
+
+  Args:
+    f: A binary file opened for writing.
+    records: An iterable of non-empty dicts to write.
+    shared_fields: An optional dict of fields prepended to every record. These
+                   are serialized once up front rather than once per record.
+  """
+  # Records are spliced onto the serialized shared fields as
+  # '{"shared":...,' + '"field":...}'.
+  prefix = b'{'
+  if shared_fields:
+    prefix = dumps(shared_fields)[:-1] + b','
+  f.write(b'[')
+  first = True
+  for record in records:
+    if not first:
+      f.write(b',')
+    first = False
+    f.write(prefix)
+    f.write(dumps(record)[1:])
+  f.write(b']')
+
+
+def get_execution_root(workspace_root):
+  """Gets the bazel execution root for a workspace.
+
+  The value is taken from the BUILD_EXECROOT environment variable if set and
+  otherwise looked up with `bazel info execution_root`. Callers that already
+  know the execution root, such as xtool, should pass it explicitly instead as
+  this requires the bazel server.
+
+  Args:
+    workspace_root: The workspace root path.
+
+  Returns:
+    The execution root path.
+  """
+  execution_root = os.environ.get('BUILD_EXECROOT')
+  if execution_root:
+    return execution_root
+  return subprocess.check_output(
+      ('bazel', 'info', 'execution_root'),
+      cwd=workspace_root).decode('utf-8').rstrip()
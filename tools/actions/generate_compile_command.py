@@ -17,43 +17,93 @@
 """A Bazel extra_action which genenerates LLVM compilation database files.
 The files written are consumed by the generate_compile_commands_json.py script
 to collapse them into a single database.
+
+If the XRTL_HEADER_DB environment variable is set for the action (such as
+with --action_env=XRTL_HEADER_DB=/tmp/headers.db) it names a SQLite database
+shared by all compile actions in the build. Each header is owned by the first
+unit to claim it, keyed by the unit's output file, and is only written by that
+unit, including when the unit's action is rerun. The database can be kept
+across builds. Headers are only lost if their owning unit is removed or stops
+including them, in which case the database should be deleted.
 """
 
+import os
+import sqlite3
 import sys
 
 import third_party.bazel.extra_actions_base_pb2 as extra_actions_base_pb2
 
 
-# When set commands will be emitted for all .h files required per unit.
+# When set commands will be emitted for all headers required per unit.
 INCLUDE_ALL_HEADERS = True
 
+# File suffixes treated as headers when INCLUDE_ALL_HEADERS is set.
+_HEADER_SUFFIXES = ('.h', '.hh', '.hpp', '.hxx', '.inc')
+
+
+def _claim_headers(headers, owner):
+  """Claims headers in the shared header database, if one is configured.
+
+  Args:
+    headers: A list of header paths used by the current unit.
+    owner: A value uniquely identifying the current unit.
+
+  Returns:
+    The headers owned by the current unit, or all headers if no database is
+    configured.
+  """
+  header_db_path = os.environ.get('XRTL_HEADER_DB')
+  if not header_db_path:
+    return headers
+  # Autocommit mode so that the transaction below can be controlled explicitly.
+  db = sqlite3.connect(header_db_path, timeout=60, isolation_level=None)
+  try:
+    db.execute('PRAGMA journal_mode=WAL')
+    db.execute('PRAGMA synchronous=NORMAL')
+    db.execute('CREATE TABLE IF NOT EXISTS headers('
+               'path TEXT PRIMARY KEY, owner TEXT NOT NULL)')
+    db.execute('BEGIN IMMEDIATE')
+    claimed_headers = []
+    for header in headers:
+      db.execute('INSERT OR IGNORE INTO headers(path, owner) VALUES(?, ?)',
+                 (header, owner))
+      (header_owner,) = db.execute('SELECT owner FROM headers WHERE path = ?',
+                                   (header,)).fetchone()
+      if header_owner == owner:
+        claimed_headers.append(header)
+    db.execute('COMMIT')
+  finally:
+    db.close()
+  return claimed_headers
+
 
 def _get_cpp_command(cpp_compile_info):
   compiler = cpp_compile_info.tool
   options = ' '.join(cpp_compile_info.compiler_option)
   source = cpp_compile_info.source_file
+  output = cpp_compile_info.output_file
   if len(cpp_compile_info.sources_and_headers) and INCLUDE_ALL_HEADERS:
-    sources = [source] + \
-              [source_file for source_file in cpp_compile_info.sources_and_headers
-               if source_file.endswith('.h')]
+    sources = [source] + _claim_headers(
+        [source_file for source_file in cpp_compile_info.sources_and_headers
+         if source_file != source and source_file.endswith(_HEADER_SUFFIXES)],
+        owner=output)
   else:
     sources = [source]
-  output = cpp_compile_info.output_file
   return '%s %s -c %s -o %s' % (compiler, options, source, output), sources
 
 
 def main(argv):
   action = extra_actions_base_pb2.ExtraActionInfo()
   with open(argv[1], 'rb') as f:
-    action.MergeFromString(f.read())
+    action.ParseFromString(f.read())
   command, source_files = _get_cpp_command(
       action.Extensions[extra_actions_base_pb2.CppCompileInfo.cpp_compile_info])
-  with open(argv[2], 'w') as f:
-    for source_file in source_files:
-      f.write(command)
-      f.write('\0')
-      f.write(source_file)
-      f.write('\0')
+  # The command is shared by all sources so it is written once, followed by
+  # each source and an empty field terminating the list:
+  #   command\0source1\0source2\0...\0\0
+  payload = '\0'.join([command] + source_files) + '\0\0'
+  with open(argv[2], 'wb') as f:
+    f.write(payload.encode('utf-8'))
 
 
 if __name__ == '__main__':
@@ -18,69 +18,235 @@
 
 Usage:
   bazel --experimental_action_listener=//tools/actions:generate_compile_commands_listener
+
+By default (--format=v1) the output is a standard clang JSON compilation
+database with the directory repeated in every entry. --format=v2 writes the
+directory once for the whole database instead:
+
+  {"directory": "...", "entries": [{"command": "...", "file": "..."}, ...]}
+
+clang tooling only reads v1. A v2 file can be converted to v1 with:
+
+  import json
+  with open('compile_commands_v2.json') as f:
+    db = json.load(f)
+  with open('compile_commands.json', 'w') as f:
+    json.dump([dict(e, directory=db['directory']) for e in db['entries']], f)
 """
 
 import argparse
-import fnmatch
-import os.path
-import subprocess
+import concurrent.futures
+import hashlib
+import itertools
+import os
+import pickle
 import sys
 
+import action_outputs
+
+
+# Bumped whenever the parse cache contents change.
+_CACHE_VERSION = 1
 
-def _get_commands_from_file(file_path, command_directory):
+# Pickle protocol of the parse cache. This is pinned rather than using
+# pickle.HIGHEST_PROTOCOL so that any Python 3 interpreter xtool selects can
+# read a cache written by another.
+_CACHE_PICKLE_PROTOCOL = 4
+
+# File suffixes treated as headers. This should match generate_compile_command.
+_HEADER_SUFFIXES = ('.h', '.hh', '.hpp', '.hxx', '.inc')
+
+
+def _parse_commands(contents):
+  """Parses the fields of a *_compile_command file into commands.
+
+  Args:
+    contents: An iterator over the NUL-separated fields of the file.
+  Returns:
+    A list of compile_commands.json entries without the directory.
+  """
+  commands = []
+  append_command = commands.append
+  # Contents are a command followed by the files it applies to, with the list
+  # of files terminated by an empty field. See generate_compile_command.
+  for command in contents:
+    if not command:
+      continue
+    for file_path in contents:
+      if not file_path:
+        break
+      append_command({
+          'command': command,
+          'file': file_path,
+      })
+  return commands
+
+
+def _get_commands_from_file(file_path):
   """Gets a set of commands for a single file.
 
   Args:
     file_path: The path to a *_compile_command file.
-    command_directory: The directory commands are run from.
   Returns:
-    A string to append to compile_commands.json.
+    A list of compile_commands.json entries without the directory, which is
+    shared by all entries and added when the database is written.
+  """
+  # Splitting the whole file in one pass keeps the scan for NUL separators in
+  # C, which is much faster than walking the fields from Python.
+  with open(file_path, 'rb') as f:
+    return _parse_commands(iter(f.read().decode('utf-8').split('\0')))
+
+
+def _load_cache(cache_path):
+  """Loads a parse cache written by _save_cache.
+
+  Args:
+    cache_path: The path of the cache file.
+
+  Returns:
+    A dict of action output file path to a ((st_mtime_ns, st_size), entries)
+    tuple. Empty if the cache does not exist or cannot be read.
+  """
+  try:
+    with open(cache_path, 'rb') as f:
+      cache = pickle.load(f)
+    if cache.get('version') != _CACHE_VERSION:
+      return {}
+    files = cache['files']
+  except (OSError, EOFError, pickle.UnpicklingError, AttributeError, KeyError,
+          TypeError, ValueError, ImportError):
+    # Missing, truncated, or otherwise unreadable caches are just rebuilt.
+    return {}
+  # Only trust the cache if every value has the shape written by _save_cache.
+  if not isinstance(files, dict):
+    return {}
+  for value in files.values():
+    if (not isinstance(value, tuple) or len(value) != 2 or
+        not isinstance(value[0], tuple) or not isinstance(value[1], list)):
+      return {}
+  return files
+
+
+def _save_cache(cache_path, files):
+  """Writes a parse cache to be loaded by _load_cache.
+
+  Args:
+    cache_path: The path of the cache file.
+    files: A dict as returned by _load_cache.
+  """
+  try:
+    os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+    # Written to a temporary file first so that readers never see a partial
+    # cache.
+    temp_path = '%s.%d.tmp' % (cache_path, os.getpid())
+    with open(temp_path, 'wb') as f:
+      pickle.dump({'version': _CACHE_VERSION, 'files': files}, f,
+                  protocol=_CACHE_PICKLE_PROTOCOL)
+    os.replace(temp_path, cache_path)
+  except (IOError, OSError):
+    # The cache is only an optimization.
+    pass
+
+
+def _get_cache_path(path):
+  """Gets the parse cache file path for an action output directory.
+
+  Args:
+    path: A directory path to look for *_compile_command files under.
+
+  Returns:
+    A path under ~/.cache/xrtl unique to the directory.
   """
-  with open(file_path, 'r') as f:
-    contents = f.read().split('\0')
-    commands = []
-    for i in range(0, len(contents) / 2):
-      command = contents[i * 2].replace('"', '\\"')
-      file_path = contents[i * 2 + 1]
-      commands.append('''{
-        "directory": "%s",
-        "command": "%s",
-        "file": "%s"
-      },''' % (
-          command_directory,
-          command,
-          file_path,
-      ))
-    return commands
-
-
-def _get_compile_commands(path, command_directory):
+  path_hash = hashlib.sha1(os.path.abspath(path).encode('utf-8')).hexdigest()
+  return os.path.join(os.path.expanduser('~'), '.cache', 'xrtl',
+                      'compile_commands', path_hash)
+
+
+def _get_compile_commands(path, cache_path=None):
   """Recursively iterates all paths and gets the commands for all files within.
 
   Args:
     path: A directory path to look for *_compile_command files under.
-    command_directory: The directory commands are run from.
+    cache_path: An optional parse cache file path. Files whose mtime and size
+                match the cache are not read again, and the cache is updated
+                with the current files.
 
   Returns:
-    A list of strings to append to compile_commands.json.
+    A list of compile_commands.json entries without the directory.
+  """
+  cache = _load_cache(cache_path) if cache_path else {}
+  files = {}
+  file_paths = []
+  stale_paths = []
+  for entry in action_outputs.iter_action_files(path, '_compile_command'):
+    st = entry.stat(follow_symlinks=False)
+    stamp = (st.st_mtime_ns, st.st_size)
+    cached = cache.get(entry.path)
+    if cached and cached[0] == stamp:
+      files[entry.path] = cached
+    else:
+      files[entry.path] = (stamp, None)
+      stale_paths.append(entry.path)
+    file_paths.append(entry.path)
+
+  with concurrent.futures.ThreadPoolExecutor(
+      max_workers=action_outputs.MAX_WORKERS) as executor:
+    for file_path, commands in zip(
+        stale_paths, executor.map(_get_commands_from_file, stale_paths)):
+      files[file_path] = (files[file_path][0], commands)
+
+  # Only current files are saved so removed outputs are purged from the cache.
+  if cache_path:
+    _save_cache(cache_path, files)
+  return list(itertools.chain.from_iterable(
+      files[file_path][1] for file_path in file_paths))
+
+
+def _dedupe_commands(commands):
+  """Filters out duplicate compile commands.
+
+  Each (file, command) pair is kept only once. Headers are included by many
+  units with differing commands and tools only need one of them, so only the
+  first command seen for each header is kept.
+
+  Args:
+    commands: An iterable of compile_commands.json entries.
+
+  Yields:
+    The entries that have not been seen before.
   """
-  all_commands = []
-  for root, dirnames, filenames in os.walk(path):
-    for filename in fnmatch.filter(filenames, '*_compile_command'):
-      file_path = os.path.join(root, filename)
-      commands = _get_commands_from_file(file_path, command_directory)
-      if commands:
-        all_commands.extend(commands)
-  return all_commands
+  seen = set()
+  for command in commands:
+    file_path = command['file']
+    if file_path.endswith(_HEADER_SUFFIXES):
+      key = file_path
+    else:
+      # Commands are long so only a fingerprint is kept to bound memory.
+      key = (file_path, hashlib.blake2b(command['command'].encode('utf-8'),
+                                        digest_size=8).digest())
+    if key in seen:
+      continue
+    seen.add(key)
+    yield command
 
 
 def main():
   parser = argparse.ArgumentParser(prog='generate_compile_commands_json')
-  parser.add_argument('--workspace_root', help='.')
-  parser.add_argument('--execution_root', help='bazel info execution_root')
+  parser.add_argument('--workspace_root', default='.', help='.')
+  parser.add_argument('--execution_root',
+                      help='bazel info execution_root. Looked up from the '
+                           'workspace if omitted.')
   parser.add_argument('--build_root', help='bazel-out/[config]/')
   parser.add_argument('--output_file', default='compile_commands.json',
                       help='Output file path for the database file.')
+  parser.add_argument('--format', choices=('v1', 'v2'), default='v1',
+                      help='v1 for a clang compilation database or v2 to '
+                           'write the directory once for all entries.')
+  parser.add_argument('--cache', action='store_true',
+                      help='Keep a parse cache under ~/.cache/xrtl so that '
+                           'unchanged files are not reparsed on the next run. '
+                           'Only useful if action outputs are kept between '
+                           'runs, which xtool does not do.')
 
   # If the user passed no args, die nicely.
   if len(sys.argv) == 1:
@@ -92,14 +258,20 @@ def main():
                              'extra_actions',
                              'tools/actions/generate_compile_commands_action')
   action_outs = action_outs.replace('/', os.sep)
-  commands = _get_compile_commands(action_outs, args['execution_root'])
-  with open(args['output_file'], 'w') as f:
-    f.write('[')
-    for command in commands:
-      f.write(command)
-    # Delete the last comma to make the file valid JSON.
-    f.seek(f.tell()-1)
-    f.write(']')
+  execution_root = (args['execution_root'] or
+                    action_outputs.get_execution_root(args['workspace_root']))
+  cache_path = _get_cache_path(action_outs) if args['cache'] else None
+  commands = _dedupe_commands(_get_compile_commands(action_outs, cache_path))
+  with open(args['output_file'], 'wb') as f:
+    if args['format'] == 'v2':
+      f.write(b'{"directory":')
+      f.write(action_outputs.dumps(execution_root))
+      f.write(b',"entries":')
+      action_outputs.write_json_array(f, commands)
+      f.write(b'}')
+    else:
+      action_outputs.write_json_array(
+          f, commands, shared_fields={'directory': execution_root})
   return 0
 
 
@@ -27,26 +27,28 @@ import third_party.bazel.extra_actions_base_pb2 as extra_actions_base_pb2
 def main(argv):
   action = extra_actions_base_pb2.ExtraActionInfo()
   with open(argv[1], 'rb') as f:
-    action.MergeFromString(f.read())
+    action.ParseFromString(f.read())
 
   # From CppLink:
   cpp_link_info = action.Extensions[extra_actions_base_pb2.CppLinkInfo.cpp_link_info]
   if cpp_link_info.link_target_type != 'EXECUTABLE':
-    # Skip all STATIC_LIBRARYs.
-    with open(argv[2], 'w') as f:
+    # Skip all STATIC_LIBRARYs. Bazel requires the output to exist, so leave
+    # an empty file that generate_link_targets_json.py will not open.
+    with open(argv[2], 'wb'):
       pass
     return 0
 
   # Write out required data for generate_link_targets_json.py.
-  with open(argv[2], 'w') as f:
-    # //some/path:rule
-    f.write(action.owner)
-    f.write('\0')
-    # 1517a....
-    f.write(action.id)
-    f.write('\0')
-    # bazel-out/.../some.exe
-    f.write(cpp_link_info.output_file)
+  payload = '\0'.join([
+      # //some/path:rule
+      action.owner,
+      # 1517a....
+      action.id,
+      # bazel-out/.../some.exe
+      cpp_link_info.output_file,
+  ])
+  with open(argv[2], 'wb') as f:
+    f.write(payload.encode('utf-8'))
 
 
 if __name__ == '__main__':
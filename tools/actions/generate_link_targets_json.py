@@ -21,37 +21,35 @@ Usage:
 """
 
 import argparse
-import fnmatch
-import os.path
-import subprocess
+import concurrent.futures
+import functools
+import os
 import sys
 
+import action_outputs
+
 
 def _get_link_target_from_file(file_path, command_directory):
   """Gets a link target for a single executable.
 
   Args:
-    file_path: The path to a *_compile_command file.
+    file_path: The path to a *_link_target file.
     command_directory: The directory commands are run from.
   Returns:
-    A string to append to link_targets.json or None if the file was empty.
+    A link_targets.json entry or None if the file was empty.
   """
-  with open(file_path, 'r') as f:
+  with open(file_path, 'r', encoding='utf-8') as f:
     contents = f.read().split('\0')
     if len(contents) < 3:
       return None
     target_package = contents[0]
     target_uuid = contents[1]
     target_executable = os.path.join(command_directory, contents[2])
-    return '''{
-      "package": "%s",
-      "uuid": "%s",
-      "executable": "%s"
-    },''' % (
-        target_package,
-        target_uuid,
-        target_executable.replace('\\', '\\\\'),
-    )
+    return {
+        'package': target_package,
+        'uuid': target_uuid,
+        'executable': target_executable,
+    }
 
 
 def _get_link_targets(path, command_directory):
@@ -62,22 +60,26 @@ def _get_link_targets(path, command_directory):
     command_directory: The directory commands are run from.
 
   Returns:
-    A list of strings to append to compile_commands.json.
+    A list of link_targets.json entries.
   """
-  all_targets = []
-  for root, dirnames, filenames in os.walk(path):
-    for filename in fnmatch.filter(filenames, '*_link_target'):
-      file_path = os.path.join(root, filename)
-      target = _get_link_target_from_file(file_path, command_directory)
-      if target:
-        all_targets.append(target)
-  return all_targets
+  file_paths = [
+      entry.path
+      for entry in action_outputs.iter_action_files(path, '_link_target')]
+  with concurrent.futures.ThreadPoolExecutor(
+      max_workers=action_outputs.MAX_WORKERS) as executor:
+    all_targets = executor.map(
+        functools.partial(_get_link_target_from_file,
+                          command_directory=command_directory),
+        file_paths)
+    return [target for target in all_targets if target]
 
 
 def main():
   parser = argparse.ArgumentParser(prog='generate_link_targets_json')
-  parser.add_argument('--workspace_root', help='.')
-  parser.add_argument('--execution_root', help='bazel info execution_root')
+  parser.add_argument('--workspace_root', default='.', help='.')
+  parser.add_argument('--execution_root',
+                      help='bazel info execution_root. Looked up from the '
+                           'workspace if omitted.')
   parser.add_argument('--build_root', help='bazel-out/[config]/')
   parser.add_argument('--output_file', default='link_targets.json',
                       help='Output file path for the database file.')
@@ -92,14 +94,11 @@ def main():
                              'extra_actions',
                              'tools/actions/generate_link_targets_action')
   action_outs = action_outs.replace('/', os.sep)
-  targets = _get_link_targets(action_outs, args['execution_root'])
-  with open(args['output_file'], 'w') as f:
-    f.write('[')
-    for target in targets:
-      f.write(target)
-    # Delete the last comma to make the file valid JSON.
-    f.seek(f.tell()-1)
-    f.write(']')
+  execution_root = (args['execution_root'] or
+                    action_outputs.get_execution_root(args['workspace_root']))
+  targets = _get_link_targets(action_outs, execution_root)
+  with open(args['output_file'], 'wb') as f:
+    action_outputs.write_json_array(f, targets)
   return 0
 
 